@@ -18,13 +18,45 @@ Example for `JavaScript.sublime-settings`:
 
 Note: `$1.extension` is replaced with a temporary file containing the
 current code to format.
+
+A save waits up to "formatter_save_timeout" seconds (default 1) for the
+formatter. Slower formatters are applied when done and the view is saved
+a second time; closing the view before then discards their result.
+
+Formatters that read the code from stdin and print the result to stdout
+can skip the temporary file altogether:
+
+    {
+        "formatter": ["/usr/local/bin/black", "--quiet", "-"],
+        "formatter_stdin": true
+    }
+
+Formatters with an expensive startup can instead run as a long-lived
+worker process that is started once and reused ("formatter_daemon": true).
+The worker reads requests framed as b"<length>\n<code>" on stdin and
+answers on stdout with b"<status> <length>\n<payload>", where the payload
+is the formatted code for status 0 and an error message otherwise.
+Lengths count the bytes of the UTF-8 encoded code or payload. A worker
+that does not reply within DAEMON_TIMEOUT seconds is restarted.
 """
 
+import atexit
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+import difflib
+import errno
+import functools
 import logging
+import mmap
+import multiprocessing
 import os
 import re
-from subprocess import PIPE, Popen
+import shutil
+import string
+import sys
+from subprocess import PIPE, Popen, TimeoutExpired
 import tempfile
+import threading
 import time
 
 import sublime
@@ -35,11 +67,64 @@ logging.basicConfig(
     level=logging.INFO, format=" %(asctime)s - %(levelname)s - %(message)s"
 )
 
+# The `$1.extension` placeholder; analyze_command checks it without regex.
 FILENAME_PATTERN = re.compile(r"\$1(\.\w+)$", flags=re.ASCII)
-ERROR_PATTERN_1 = re.compile(
-    rb"\bline (?P<line>\d+)(?:.*\bcolumn (?P<column>\d+))?", flags=re.I
+EXTENSION_CHARACTERS = frozenset(string.ascii_letters + string.digits + "_")
+ERROR_PATTERN = re.compile(
+    # "line 10, column 5" type of errors.
+    rb"\bline (?P<line>\d+)(?:.*\bcolumn (?P<column>\d+))?"
+    # "10:5" type of errors.
+    rb"|\b(?P<row>\d+):(?P<col>\d+)\b",
+    flags=re.I,
+)
+TEMPFILE_FLAGS = (
+    os.O_RDWR | getattr(os, "O_BINARY", 0) | getattr(os, "O_NOATIME", 0)
 )
-ERROR_PATTERN_2 = re.compile(rb"\b(\d+):(\d+)\b", flags=re.I)
+# Default seconds a save waits for the formatter before saving unformatted
+# and saving again once it finishes.
+SAVE_TIMEOUT = 1.0
+# Seconds to wait for a daemon worker's reply before restarting it.
+DAEMON_TIMEOUT = 30
+# Buffers with more lines than this are replaced whole instead of diffed,
+# since line diffs slow down quadratically on repeated lines.
+DIFF_MAX_LINES = 5000
+# Results larger than this are read back through a memory map.
+MMAP_THRESHOLD = 65536
+
+
+def pool_size():
+    # os.cpu_count() is Python 3.4+; Sublime Text 3 runs plugins on 3.3.
+    try:
+        return max(2, multiprocessing.cpu_count() - 1)
+    except NotImplementedError:
+        return 2
+
+
+# Formats run here, so saving several views formats them in parallel.
+_POOL = ThreadPoolExecutor(max_workers=pool_size())
+# Views being saved again after their formatted text has been applied.
+_RESAVING = set()
+# Open temporary files reused across saves: (view id, suffix) -> (fd, path).
+_TEMP_FILES = {}
+# Locks serializing formats of the same view, which share temporary files.
+_VIEW_LOCKS = {}
+# Ids of closed views, so queued formats for them do nothing.
+_CLOSED_VIEWS = set()
+# Last successful format per view id:
+# (command, change count, hash of result, hash of input, result).
+_LAST_FORMAT = {}
+# Resolved executable paths, keyed by (name, PATH).
+_EXECUTABLES = {}
+# Long-lived formatter worker processes and their locks, keyed by command.
+_DAEMONS = {}
+_DAEMON_LOCKS = {}
+
+
+def plugin_unloaded():
+    for key in list(_TEMP_FILES):
+        remove_tempfile(*key)
+    stop_daemons()
+    _POOL.shutdown(wait=False)
 
 
 class ShellNonZeroExitCode(Exception):
@@ -49,33 +134,102 @@ class ShellNonZeroExitCode(Exception):
 class RunFormatEventListener(sublime_plugin.EventListener):
     @classmethod
     def on_pre_save(cls, view):
-        first = time.perf_counter()
-        view.run_command("run_custom_formatter")
-        second = time.perf_counter()
-        print("[Custom Formatter]", round(second - first, 6), "seconds runtime.")
+        if view.id() in _RESAVING:
+            _RESAVING.discard(view.id())
+            return
+        view.run_command("run_custom_formatter", {"save": True})
 
     @classmethod
     def on_post_save_async(cls, view):
         pass
 
+    @classmethod
+    def on_close(cls, view):
+        view_id = view.id()
+        _CLOSED_VIEWS.add(view_id)
+        _RESAVING.discard(view_id)
+        _LAST_FORMAT.pop(view_id, None)
+        lock = _VIEW_LOCKS.pop(view_id, None)
+        # A format still running removes the files itself when it is done;
+        # waiting for it here would block the UI thread.
+        if lock is None or lock.acquire(blocking=False):
+            remove_tempfiles(view_id)
+            if lock is not None:
+                lock.release()
+
 
 class RunCustomFormatterCommand(sublime_plugin.TextCommand):
-    def run(self, edit):
+    def run(self, edit, save=False):
+        """Snapshot the buffer and format it off the UI thread."""
         view = self.view
-        formatter = view.settings().get("formatter")
+        settings = view.settings()
+        formatter = settings.get("formatter")
         if not formatter:
             return
-
-        region = sublime.Region(0, view.size())
-        text = view.substr(region)
-        # logging.info("Formatting with: " + formatter[0])
-        try:
-            text = format_text(text, formatter)
-        except ShellNonZeroExitCode as error:
-            point_out_issue_to_user(error, view)
+        if settings.get("formatter_daemon"):
+            mode = "daemon"
+        elif settings.get("formatter_stdin"):
+            mode = "stdin"
+        else:
+            mode = "file"
+
+        change_count = view.change_count()
+        last = _LAST_FORMAT.get(view.id())
+        if last and last[0] != formatter:
+            last = None
+        if last and last[1] == change_count:
+            # Nothing was edited since the last format.
+            return
+        # Keep only the encoded copy of the buffer from here on.
+        data = view.substr(sublime.Region(0, view.size())).encode("utf-8")
+        data_hash = hash(data)
+        if last and last[2] == data_hash:
+            # The buffer already holds the formatter's output.
+            return
+        if last and last[3] == data_hash:
+            # The buffer is back to the last input; reuse the output.
+            future = _POOL.submit(diff_in_background, data, last[4], formatter)
         else:
+            # logging.info("Formatting with: " + formatter[0])
+            debug = settings.get("custom_formatter_debug")
+            future = _POOL.submit(
+                format_in_background, view.id(), data, formatter, mode, debug
+            )
+        finish = functools.partial(
+            finish_format, view, future, data, formatter, change_count, []
+        )
+        future.add_done_callback(
+            lambda future: sublime.set_timeout(lambda: finish(save), 0)
+        )
+        if save:
+            # Quick formatters land in this very save, like a synchronous
+            # format; slower ones are applied and saved again when done.
+            timeout = settings.get("formatter_save_timeout", SAVE_TIMEOUT)
+            try:
+                future.result(timeout=timeout)
+            except FutureTimeoutError:
+                return
+            finish(False)
+
+
+class ApplyFormattedTextCommand(sublime_plugin.TextCommand):
+    def run(self, edit, hunks):
+        """Apply the (begin, end, text) replacements computed by diff_hunks.
+
+        Sublime shifts the cursors and viewport over hunks after the
+        selection; for hunks touching or before it they are restored.
+        """
+        view = self.view
+        replace = view.replace
+        Region = sublime.Region
+        selection = view.sel()
+        # Hunks come last to first, so the final one starts the earliest.
+        restore = len(selection) > 0 and hunks[-1][0] <= selection[0].end()
+        if restore:
             position = save_cursor_and_viewport_position(view)
-            view.replace(edit, region, text)
+        for begin, end, text in hunks:
+            replace(edit, Region(begin, end), text)
+        if restore:
             set_cursor_and_viewport_position(position, view)
 
 
@@ -92,26 +246,120 @@ class GotoPositionCommand(sublime_plugin.TextCommand):
 # Actions
 
 
-def format_text(text, command):
-    suffix = extract_extension(command)
+def format_text(data, command, view_id, mode="file"):
+    """Format the UTF-8 encoded code `data` with `command`, return bytes.
+
+    `mode` is "file" to pass the code in a temporary file, "stdin" to pipe
+    it through stdin/stdout, or "daemon" to send it to a long-lived worker.
+    """
+    if mode == "stdin":
+        return normalize_newlines(run_shell_command(command, data))
+    if mode == "daemon":
+        return normalize_newlines(run_daemon_command(command, data))
+
+    suffix, placeholders = analyze_command(tuple(command))
+    filepath = write_tempfile(data, suffix, view_id)[1]
     try:
-        filepath = write_tempfile(text, suffix)
-        command = [
-            filepath if FILENAME_PATTERN.match(item) else item for item in command
-        ]
+        command = list(command)
+        for index in placeholders:
+            command[index] = filepath
         # logging.info(command)
         run_shell_command(command)
-        with open(filepath, encoding="utf-8") as file:
-            result = file.read()
+        result = normalize_newlines(read_tempfile(view_id, suffix, data))
 
-    finally:
-        if os.path.isfile(filepath):
-            os.remove(filepath)
+    except BaseException:
+        remove_tempfile(view_id, suffix)
+        raise
 
     return result
 
 
-def point_out_issue_to_user(error, view):
+def format_in_background(view_id, data, command, mode, debug):
+    """Run the formatter on a worker thread.
+
+    Return (result, hunks), the ShellNonZeroExitCode raised, or None if the
+    view was closed or formatting failed unexpectedly. This may run while
+    the UI thread waits for it, so it must not call the Sublime API.
+    """
+    if debug:
+        first = time.perf_counter()
+    try:
+        result = format_for_view(view_id, data, command, mode)
+        if result is None:
+            return None
+        return result, diff_hunks(data, result)
+    except ShellNonZeroExitCode as error:
+        return error
+    except Exception:
+        # Nobody else sees the pool's exceptions, so report it here.
+        logging.exception("Formatting with %s failed", command)
+        return None
+    finally:
+        if debug:
+            second = time.perf_counter()
+            print(
+                "[Custom Formatter]", round(second - first, 6), "seconds runtime."
+            )
+
+
+def diff_in_background(data, result, command):
+    """Diff a known result on a worker thread; return (result, hunks)."""
+    try:
+        return result, diff_hunks(data, result)
+    except Exception:
+        logging.exception("Diffing the output of %s failed", command)
+        return None
+
+
+def format_for_view(view_id, data, command, mode):
+    """Format under the view's lock; return None if the view was closed."""
+    with _VIEW_LOCKS.setdefault(view_id, threading.Lock()):
+        if view_id in _CLOSED_VIEWS:
+            return None
+        try:
+            return format_text(data, command, view_id, mode)
+        finally:
+            if view_id in _CLOSED_VIEWS:
+                # on_close could not take the lock and left the cleanup here.
+                remove_tempfiles(view_id)
+
+
+def finish_format(view, future, data, command, change_count, handled, save):
+    """Apply the outcome of a format job on the UI thread, only once."""
+    if handled or future.cancelled():
+        return
+    handled.append(True)
+    outcome = future.result()
+    if isinstance(outcome, ShellNonZeroExitCode):
+        point_out_issue_to_user(outcome, view, change_count)
+    elif outcome is not None:
+        result, hunks = outcome
+        apply_formatted_text(view, data, result, hunks, command, change_count, save)
+
+
+def apply_formatted_text(view, data, result, hunks, command, change_count, save):
+    if not view.is_valid() or view.change_count() != change_count:
+        # The buffer was edited while formatting; the result is stale.
+        return
+    changed = result != data
+    if changed:
+        view.run_command("apply_formatted_text", {"hunks": hunks})
+    _LAST_FORMAT[view.id()] = (
+        command,
+        view.change_count(),
+        hash(result),
+        hash(data),
+        result,
+    )
+    if save and changed:
+        _RESAVING.add(view.id())
+        view.run_command("save")
+
+
+def point_out_issue_to_user(error, view, change_count):
+    if not view.is_valid() or view.change_count() != change_count:
+        # The buffer was edited while formatting; the position is stale.
+        return
     error_message = error.args[0]
     position = extract_position_with_issue(error_message)
     if not position:
@@ -123,34 +371,180 @@ def point_out_issue_to_user(error, view):
 # Helpers
 
 
-def write_tempfile(text, suffix):
-    with tempfile.NamedTemporaryFile(
-        mode="w+", delete=False, suffix=suffix, encoding="utf-8"
-    ) as file:
-        filepath = file.name
-        file.write(text)
-    return filepath
+def write_tempfile(data, suffix, view_id):
+    """Write `data` to the view's temporary file, creating it if needed.
+
+    Return (fd, path). On POSIX the descriptor stays open to read the result
+    back. On Windows it is closed and fd is None, because a formatter cannot
+    rename a new file over one that is still open.
+    """
+    key = (view_id, suffix)
+    fd, filepath = _TEMP_FILES.get(key, (None, None))
+    if filepath is None:
+        fd, filepath = tempfile.mkstemp(suffix=suffix)
+        write_all(fd, data)
+    elif fd is None:
+        # Truncate on open; Windows has no os.ftruncate before Python 3.5.
+        flags = TEMPFILE_FLAGS | os.O_CREAT | os.O_TRUNC
+        fd = os.open(filepath, flags, 0o600)
+        write_all(fd, data)
+    else:
+        write_all(fd, data)
+        os.ftruncate(fd, len(data))
+    if os.name == "nt":
+        os.close(fd)
+        fd = None
+    _TEMP_FILES[key] = fd, filepath
+    return fd, filepath
+
+
+def read_tempfile(view_id, suffix, original):
+    """Read back the view's temporary file through its open descriptor.
+
+    Return `original` itself when the formatter left the code unchanged.
+    """
+    key = (view_id, suffix)
+    fd, filepath = _TEMP_FILES[key]
+    stat = None if fd is None else os.fstat(fd)
+    if stat is None or stat.st_nlink == 0:
+        # Either the file was closed for the formatter (on Windows) or the
+        # formatter replaced it instead of rewriting it in place.
+        if fd is not None:
+            os.close(fd)
+        fd = os.open(filepath, TEMPFILE_FLAGS)
+        _TEMP_FILES[key] = fd, filepath
+        stat = os.fstat(fd)
+    try:
+        if stat.st_size <= MMAP_THRESHOLD:
+            return read_all(fd, stat.st_size)
+        # Compare in place, so unchanged large files are never copied.
+        with mmap.mmap(fd, stat.st_size, access=mmap.ACCESS_READ) as mapping:
+            with memoryview(mapping) as contents:
+                if contents == original:
+                    return original
+                return contents.tobytes()
+    finally:
+        if os.name == "nt":
+            os.close(fd)
+            _TEMP_FILES[key] = None, filepath
 
 
-def extract_position_with_issue(error_message):
-    """Return (row, column) with issue from error message."""
-    # "line 10, column 5" type of errors.
-    match = ERROR_PATTERN_1.search(error_message)
-    if match:
-        position = match.groupdict()
-        return (int(position.get("line")), int(position.get("column") or 1))
-    # "10:5" type of errors.
-    match = ERROR_PATTERN_2.search(error_message)
-    if match:
-        return (int(match.group(1)), int(match.group(2)))
+def remove_tempfile(view_id, suffix):
+    fd, filepath = _TEMP_FILES.pop((view_id, suffix), (None, None))
+    if filepath is None:
+        return
+    if fd is not None:
+        os.close(fd)
+    try:
+        os.unlink(filepath)
+    except FileNotFoundError:
+        pass
+
+
+def remove_tempfiles(view_id):
+    for key in [key for key in list(_TEMP_FILES) if key[0] == view_id]:
+        remove_tempfile(*key)
+
+
+def write_all(fd, data):
+    """Write all of `data` at the start of `fd`, bypassing buffered files."""
+    view = memoryview(data)
+    offset = 0
+    while offset < len(data):
+        offset += pwrite(fd, view[offset:], offset)
+
+
+def read_all(fd, size):
+    """Read `size` bytes from the start of `fd`, or fewer if it ends first."""
+    data = pread(fd, size, 0)
+    while len(data) < size:
+        chunk = pread(fd, size - len(data), len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
 
 
-def extract_extension(command):
-    for item in command:
-        match = FILENAME_PATTERN.match(item)
-        if match:
-            return match.group(1)
-    return ""
+if hasattr(os, "pwrite"):
+    # Positional I/O saves the lseek before every read and write.
+    pread, pwrite = os.pread, os.pwrite
+else:
+
+    def pread(fd, size, offset):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, size)
+
+    def pwrite(fd, data, offset):
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.write(fd, data)
+
+
+def extract_position_with_issue(error_message):
+    """Return (row, column) with issue from error message."""
+    match = ERROR_PATTERN.search(error_message)
+    if not match:
+        return None
+    if match.group("line"):
+        return (int(match.group("line")), int(match.group("column") or 1))
+    return (int(match.group("row")), int(match.group("col")))
+
+
+@functools.lru_cache(maxsize=32)
+def analyze_command(command):
+    """Return (suffix, indices of `$1.extension` items) for a command tuple."""
+    suffix = ""
+    placeholders = []
+    for index, item in enumerate(command):
+        extension = item[3:]
+        if (
+            item.startswith("$1.")
+            and extension
+            and EXTENSION_CHARACTERS.issuperset(extension)
+        ):
+            suffix = suffix or item[2:]
+            placeholders.append(index)
+    return suffix, tuple(placeholders)
+
+
+def resolve_executable(name):
+    """Return the full path of the executable `name`, searching PATH.
+
+    Results are cached per PATH and looked up again once they stop being
+    executable, e.g. after the formatter was moved or uninstalled.
+    """
+    key = (name, os.environ.get("PATH"))
+    path = _EXECUTABLES.get(key)
+    if path is None or not os.access(path, os.X_OK):
+        path = _EXECUTABLES[key] = shutil.which(name) or name
+    return path
+
+
+def diff_hunks(data, result):
+    """Return the (begin, end, text) replacements turning `data` into `result`.
+
+    Offsets are characters of the decoded code. Hunks come last to first,
+    so applying them in order keeps the earlier offsets valid.
+    """
+    if result == data:
+        return []
+    old_text = data.decode("utf-8")
+    new_text = result.decode("utf-8")
+    old_lines = old_text.splitlines(True)
+    new_lines = new_text.splitlines(True)
+    if max(len(old_lines), len(new_lines)) > DIFF_MAX_LINES:
+        return [(0, len(old_text), new_text)]
+    old_offsets = line_offsets(old_lines)
+    new_offsets = line_offsets(new_lines)
+    matcher = difflib.SequenceMatcher(a=old_lines, b=new_lines, autojunk=False)
+    return [
+        (
+            old_offsets[i1],
+            old_offsets[i2],
+            new_text[new_offsets[j1] : new_offsets[j2]],
+        )
+        for tag, i1, i2, j1, j2 in reversed(matcher.get_opcodes())
+        if tag != "equal"
+    ]
 
 
 def save_cursor_and_viewport_position(view):
@@ -169,10 +563,158 @@ def set_cursor_and_viewport_position(position, view):
     view.set_viewport_position(viewport_position)
 
 
-def run_shell_command(command):
-    process = Popen(command, stdout=PIPE, stdin=PIPE, stderr=PIPE)
-    stdout, stderr = process.communicate()
-    if process.returncode > 0:
+def normalize_newlines(data):
+    """Turn "\r\n" and "\r" line endings into "\n", as Sublime buffers use."""
+    if b"\r" not in data:
+        return data
+    return data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+
+
+def line_offsets(lines):
+    """Return the offset at which each line starts, plus the total length."""
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+    return offsets
+
+
+def run_shell_command(command, data=None):
+    """Run `command`, feeding it `data` on stdin, and return its stdout."""
+    if os.name == "nt" or sys.version_info < (3, 8):
+        process = Popen(command, stdout=PIPE, stdin=PIPE, stderr=PIPE)
+    else:
+        # On Python 3.8+, an executable path and close_fds=False let Popen
+        # use posix_spawn instead of fork+exec, which copies Sublime's page
+        # tables. The cost: every inheritable descriptor of the plugin host,
+        # e.g. ones opened outside Python, is passed on to the formatter.
+        process = Popen(
+            command,
+            executable=resolve_executable(command[0]),
+            close_fds=False,
+            stdout=PIPE,
+            stdin=PIPE,
+            stderr=PIPE,
+        )
+    # Drain stderr (and feed stdin) on helper threads while this thread reads
+    # stdout as the formatter produces it.
+    stderr_chunks = []
+    helpers = [threading.Thread(target=drain, args=(process.stderr, stderr_chunks))]
+    if data:
+        helpers.append(threading.Thread(target=feed, args=(process.stdin, data)))
+    else:
+        process.stdin.close()
+    for helper in helpers:
+        helper.start()
+    stdout_chunks = []
+    drain(process.stdout, stdout_chunks)
+    for helper in helpers:
+        helper.join()
+    process.wait()
+    stdout = b"".join(stdout_chunks)
+    stderr = b"".join(stderr_chunks)
+    if process.returncode != 0:
         logging.info(command)
         logging.error(stderr)
         raise ShellNonZeroExitCode(stderr)
+    return stdout
+
+
+def drain(file, chunks):
+    """Read `file` until EOF in 64 KiB chunks, appending them to `chunks`."""
+    fd = file.fileno()
+    while True:
+        chunk = os.read(fd, 65536)
+        if not chunk:
+            break
+        chunks.append(chunk)
+    file.close()
+
+
+def feed(file, data):
+    """Write `data` to `file` and close it, ignoring an early exit."""
+    try:
+        try:
+            file.write(data)
+        finally:
+            # Closing also retries the flush, which fails the same way.
+            file.close()
+    except BrokenPipeError:
+        # The formatter exited without reading all of its input.
+        pass
+    except OSError as error:
+        # On Windows a pipe closed by the formatter raises EINVAL instead.
+        if error.errno != errno.EINVAL:
+            raise
+
+
+def run_daemon_command(command, data):
+    """Send `data` to the long-lived worker running `command`, return reply."""
+    key = tuple(command)
+    with _DAEMON_LOCKS.setdefault(key, threading.Lock()):
+        process = _DAEMONS.get(key)
+        try:
+            if process is None or process.poll() is not None:
+                process = Popen(command, stdout=PIPE, stdin=PIPE)
+                _DAEMONS[key] = process
+            reply = []
+            exchanger = threading.Thread(
+                target=exchange, args=(process, data, reply), daemon=True
+            )
+            exchanger.start()
+            exchanger.join(DAEMON_TIMEOUT)
+            if exchanger.is_alive():
+                raise TimeoutError(
+                    "no reply within {} seconds".format(DAEMON_TIMEOUT)
+                )
+            if isinstance(reply[0], Exception):
+                raise reply[0]
+            status, payload = reply[0]
+        except (OSError, ValueError) as error:
+            # The worker failed to start, hung, died or broke the protocol;
+            # start afresh next time.
+            _DAEMONS.pop(key, None)
+            if process is not None:
+                process.kill()
+                process.wait()
+            logging.info(command)
+            logging.error(error)
+            raise ShellNonZeroExitCode(str(error).encode("utf-8"))
+        if status != 0:
+            logging.info(command)
+            logging.error(payload)
+            raise ShellNonZeroExitCode(payload)
+        return payload
+
+
+def exchange(process, data, reply):
+    """Send one framed request to `process`, append (status, payload) reply.
+
+    Errors are appended instead, for the waiting thread to raise.
+    """
+    try:
+        process.stdin.write(str(len(data)).encode("ascii") + b"\n")
+        process.stdin.write(data)
+        process.stdin.flush()
+        status, length = process.stdout.readline().split()
+        status, length = int(status), int(length)
+        payload = process.stdout.read(length)
+        if len(payload) != length:
+            raise ValueError("truncated reply")
+        reply.append((status, payload))
+    except (OSError, ValueError) as error:
+        reply.append(error)
+
+
+@atexit.register
+def stop_daemons():
+    processes = []
+    while _DAEMONS:
+        processes.append(_DAEMONS.popitem()[1])
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=1)
+        except TimeoutExpired:
+            process.kill()
+            process.wait()